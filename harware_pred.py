@@ -106,13 +106,14 @@ def Jax_Circuit(x):
   # qml.TTN(wires=range(N_QUBITS), n_block_wires=2,block=block_one, n_params_block=N_PARAMS_B, template_weights=w) 
   return qml.expval(qml.PauliZ(N_QUBITS-1))
 
+# A jet is correctly classified when the prediction has the same sign as the target
 def Accuracy(pred,y):
-  return np.mean(jax.numpy.sign(pred) == y)
+  return np.mean(pred*y > 0)
 
+# Batches are (z, BATCH_SIZE, ...) views of the jets, no stacked copy of features and targets is made
 def Batch(x,y):
   z = int(len(x) / BATCH_SIZE)
-  data = np.column_stack([x,y])
-  return np.split(data[:,0:N_QUBITS],z), np.split(data[:,-1],z),z
+  return x[:z*BATCH_SIZE].reshape(z,BATCH_SIZE,N_QUBITS), y[:z*BATCH_SIZE].reshape(z,BATCH_SIZE),z
 
 def Hardware_Predictions(x,n):
   path = "/content/drive/MyDrive/Colab Notebooks/BTR/"
@@ -150,10 +151,8 @@ ibm_pred = Hardware_Predictions(x,n)
 fname = "full_pred_circuit"+str(n)+".npy"
 np.save(fname,ibm_pred)
 ibm_acc = Accuracy(ibm_pred,test_target)
-jax_pred = np.zeros((z,BATCH_SIZE))
-for i in range(z):
-  jax_pred[i] = Jax_Circuit(x[i])
-jax_pred = np.reshape(jax_pred,(z*BATCH_SIZE))
+# Jax_Circuit is vectorized over the jets, so all the batches are predicted in one call
+jax_pred = np.asarray(jnp.reshape(Jax_Circuit(jnp.reshape(x,(-1,N_QUBITS))),(-1,)))
 jax_acc = Accuracy(jax_pred, test_target)
 print('IBM accuracy: ' + str(ibm_acc))
 print('JAX accuracy: ' + str(jax_acc))
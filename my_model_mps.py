@@ -3,12 +3,12 @@ from load_dataset import load_dataset
 import numpy as np
 import pandas as pd
 import os
-import pennylane as qml
 import matplotlib.pyplot as plt
 from functools import partial
 import jax
 import jax.numpy as jnp
 import optax
+import opt_einsum as oe
 import sklearn
 from sklearn.metrics import roc_curve, roc_auc_score 
 
@@ -26,125 +26,191 @@ HOME_PATH = '/home/leonidas/example-qml4btag/'
 
 #------------------------#
 
-# Definiton of the Pennylane device using JAX
-device = qml.device("default.qubit.jax", wires=N_QUBITS,prng_key = jax.random.PRNGKey(SEED))
+# Single precision everywhere: the training features are stored in bfloat16, the circuit runs
+# in float32/complex64 and the matrix products may use bfloat16 where the backend
+# supports it. The training is gradient based and tolerant to the lower precision.
+jax.config.update("jax_enable_x64", False)
+jax.config.update("jax_default_matmul_precision", "bfloat16")
 
 # The ADAM optimizer is initialized
 optimizer = optax.adam(LR)
 
-# The block defines a variational quantum circuit that takes the position of tensors in the circuit
-def Block(weights,wires):
-  qml.RY(weights[0], wires=wires[0])
-  qml.RX(weights[1], wires=wires[0])
-  qml.RZ(weights[2], wires=wires[1])
-  qml.RY(weights[3], wires=wires[1])
-  qml.CNOT(wires=wires)
+# Single qubit gates of the block as 2x2 matrices
+def RX(t):
+  return jnp.array([[jnp.cos(t/2), -1j*jnp.sin(t/2)], [-1j*jnp.sin(t/2), jnp.cos(t/2)]])
+
+def RY(t):
+  return jnp.array([[jnp.cos(t/2), -jnp.sin(t/2)], [jnp.sin(t/2), jnp.cos(t/2)]])
+
+def RZ(t):
+  return jnp.array([[jnp.exp(-0.5j*t), 0.], [0., jnp.exp(0.5j*t)]])
+
+CNOT = jnp.array([[1.,0.,0.,0.],[0.,1.,0.,0.],[0.,0.,0.,1.],[0.,0.,1.,0.]])
+PAULI_Z = jnp.array([[1.,0.],[0.,-1.]])
+
+# The block defines a variational quantum circuit acting on two neighbouring qubits:
+# RY, RX on the first qubit, RZ, RY on the second one and a CNOT between them.
+# Its unitary is returned as a (2,2,2,2) tensor: (out_0, out_1, in_0, in_1)
+def Block(weights):
+  u = CNOT @ jnp.kron(RX(weights[1]) @ RY(weights[0]), RY(weights[3]) @ RZ(weights[2]))
+  return jnp.reshape(u, (2,2,2,2))
+
+# One step of the contraction along the chain: the block u acts on the carried density
+# matrix rho and the new qubit q, then the first qubit is traced out (index a).
+# The contraction path is optimized only once, and the expression is reused by every
+# call, for both training and testing, as a chain of tensordots
+STEP_EXPRESSION = oe.contract_expression('abcd,cf,d,aefg,g->be', (2,2,2,2), (2,2), (2,), (2,2,2,2), (2,), optimize='auto-hq')
 
 # Definition of the quantum circuit
 # x : features from the jet structure
 # w : weights of the model
-# The qml.qnode decorator transforms the python function into a Pennylane QNode
-# i.e. a circuit to be run on a specified device.
+# The MPS circuit is a tensor network with bond dimension 2, so instead of simulating
+# the 2^N_QUBITS state vector it is contracted from left to right. Block i acts on
+# qubits i and i+1, and qubit i is not touched again, so it is traced out right away:
+# the only thing carried along the chain is the 2x2 density matrix of qubit i+1.
+# Each step is a contraction of tiny tensors, run by lax.scan over the blocks.
 # The partial(jax.vmap) decorator creates a vectorized version of the function
 # This way I can process multiple jets at one time, passing a vector of features.
 # in_axes = [0,None] specifies that I want to vectorize the function with respect
 # to the first parameter only (x), since I want the weights (w) to be the same for
 # each jet.
+@jax.jit
 @partial(jax.vmap,in_axes=[0,None]) # Vectorized version of the function
-@qml.qnode(device,interface='jax')  # Create a Pennylane QNode
 def Circuit(x,w):
-  qml.AngleEmbedding(x,wires=range(N_QUBITS))   # Features x are embedded in rotation angles
-  qml.MPS(wires=range(N_QUBITS), n_block_wires=2,block=Block, n_params_block=N_PARAMS_B, template_weights=w) # Variational layer
-  return qml.expval(qml.PauliZ(N_QUBITS-1)) # Expectation value of the \sigma_z operator on the last qubit
+  x = x.astype(jnp.float32) # bfloat16 features are upcast, there is no bfloat16 complex type
+  qubits = jnp.stack([jnp.cos(x/2), -1j*jnp.sin(x/2)], axis=1) # Features x are embedded in rotation angles, RX(x)|0>
+  blocks = jax.vmap(Block)(w) # Variational layer
+  def Step(rho,site):
+    q, u = site
+    rho = STEP_EXPRESSION(u, rho, q, jnp.conj(u), jnp.conj(q), backend='jax')
+    return rho, None
+  rho, _ = jax.lax.scan(Step, jnp.outer(qubits[0], jnp.conj(qubits[0])), (qubits[1:], blocks))
+  # Expectation value of the \sigma_z operator on the last qubit
+  # It is clipped to [-1,1], since the rounding errors of the lower precision may push it slightly out
+  return jnp.clip(jnp.trace(PAULI_Z @ rho).real, -1., 1.)
 
 # Simple MSE loss function
-def Loss(w,x,y):
-  pred = Circuit(x,w)
-  return jax.numpy.mean((pred - y) ** 2)
+def Loss(pred,y):
+  return jax.numpy.mean((pred - y) ** 2, dtype=jnp.float32)
 
 # Simple binary accuracy function
-def Accuracy(w,x,y):
+# A jet is correctly classified when the prediction has the same sign as the target
+def Accuracy(pred,y):
+  return jax.numpy.mean(pred*y > 0, dtype=jnp.float32)
+
+# The circuit is run only once per batch: the loss is returned with the accuracy
+# as auxiliary data, so jax.value_and_grad(..., has_aux=True) reuses the same forward pass
+def Loss_and_Acc(w,x,y):
   pred = Circuit(x,w)
-  return jax.numpy.mean(jax.numpy.sign(pred) == y)
+  return Loss(pred,y), Accuracy(pred,y)
 
 # Training step
 # This function is compiled Just-In-Time on the GPU
 @jax.jit
 def Train_Step(w, opt_state,x,y):
-  loss_value, grads = jax.value_and_grad(Loss,argnums=0)(w,x,y)
-  acc_value = Accuracy(w,x,y)
+  (loss_value,acc_value), grads = jax.value_and_grad(Loss_and_Acc,argnums=0,has_aux=True)(w,x,y)
   updates, opt_state = optimizer.update(grads, opt_state, w)
   w = optax.apply_updates(w, updates)
   return loss_value,acc_value, opt_state, w
 
 @jax.jit
 def Test_Step(w,x,y):
-  loss_value, grads = jax.value_and_grad(Loss,argnums=0)(w,x,y)
-  acc_value = Accuracy(w,x,y)
-  return loss_value, acc_value
+  return Loss_and_Acc(w,x,y)
+
+# Shuffle and batch the jets directly on the device
+# The jets are shuffled with a permutation drawn from the PRNG key and reshaped into
+# (n_batches, BATCH_SIZE, n_features) features and (n_batches, BATCH_SIZE) targets,
+# so the batches never leave the device
+@jax.jit
+def Batch_and_Shuffle(x,y,key):
+  z = x.shape[0] // BATCH_SIZE
+  idx = jax.random.permutation(key, x.shape[0])[:z*BATCH_SIZE]
+  return x[idx].reshape(z,BATCH_SIZE,x.shape[1]), y[idx].reshape(z,BATCH_SIZE)
 
-def Batch_and_Shuffle(x,y):
-  z = int(len(x) / BATCH_SIZE)
-  data = np.column_stack([x,y])
-  np.random.shuffle(data)
-  return np.split(data[:,0:N_QUBITS],z), np.split(data[:,-1],z),z
+# A full epoch of training
+# lax.scan runs Train_Step over the leading (batch) axis of xs and ys inside a
+# single compiled loop, carrying the weights and the optimizer state and stacking
+# the loss and accuracy of every step
+@jax.jit
+def Run_Epoch(w,opt_state,xs,ys):
+  def Body(carry,batch):
+    w,opt_state = carry
+    loss_value,acc_value, opt_state,w = Train_Step(w,opt_state,batch[0],batch[1])
+    return (w,opt_state), (loss_value,acc_value)
+  (w,opt_state), (loss_values,acc_values) = jax.lax.scan(Body,(w,opt_state),(xs,ys))
+  return loss_values,acc_values, opt_state,w
+
+# The whole test set
+# lax.map runs Test_Step over the leading (batch) axis of xs and ys inside a single
+# compiled loop and stacks the loss and accuracy of every batch on the device
+@jax.jit
+def Run_Test(w,xs,ys):
+  return jax.lax.map(lambda batch: Test_Step(w,batch[0],batch[1]),(xs,ys))
+
+# Predictions for any number of jets with constant memory
+# The jets are padded to a multiple of BATCH_SIZE, and lax.map runs the vectorized
+# Circuit one batch at a time instead of on all the jets at once
+@jax.jit
+def Predict(w,x):
+  n = x.shape[0]
+  z = -(-n // BATCH_SIZE)
+  xs = jnp.pad(x,((0,z*BATCH_SIZE-n),(0,0))).reshape(z,BATCH_SIZE,x.shape[1])
+  return jax.lax.map(lambda batch: Circuit(batch,w),xs).reshape(-1)[:n]
+
+# The whole training on the device
+# lax.fori_loop runs the N_EPOCHS epochs inside a single compiled loop: every epoch
+# the jets are shuffled with a new key split from the carried one and passed to
+# Run_Epoch, and the loss and accuracy of every step are written in the
+# (N_EPOCHS, n_batches) arrays
+# The initial weights and optimizer state are donated, they are not used after the call
+@partial(jax.jit,donate_argnums=(0,1))
+def Train_All(w,opt_state,x,y,key):
+  z = x.shape[0] // BATCH_SIZE
+  def Epoch(i,carry):
+    w,opt_state,loss_data,acc_data,key = carry
+    key, subkey = jax.random.split(key)
+    train_f, train_t = Batch_and_Shuffle(x,y,subkey)
+    loss_values,acc_values, opt_state,w = Run_Epoch(w,opt_state,train_f,train_t)
+    # Progress line every 100 epochs, printed from inside the compiled loop
+    jax.lax.cond((i+1) % 100 == 0,
+                 lambda: jax.debug.print("{}\t{:.3f}\t{:.2f}%",i+1,loss_values[-1],acc_values[-1]*100),
+                 lambda: None)
+    return w,opt_state,loss_data.at[i].set(loss_values),acc_data.at[i].set(acc_values),key
+  loss_data = jnp.zeros((N_EPOCHS,z))
+  acc_data = jnp.zeros((N_EPOCHS,z))
+  w,opt_state,loss_data,acc_data,key = jax.lax.fori_loop(0,N_EPOCHS,Epoch,(w,opt_state,loss_data,acc_data,key))
+  return loss_data,acc_data, opt_state,w
 
 def Train_Model(w:optax.Params, x, y):
   opt_state = optimizer.init(w)
-  z = int(len(x)/BATCH_SIZE)
-  loss_data = np.zeros(N_EPOCHS*z)
-  acc_data = np.zeros(N_EPOCHS*z)
-  step = 0
   print("Training...")
   print("Epoch\tLoss\tAccuracy")
-  for i in range(N_EPOCHS):
-    
-    # Batch and shuffle the data for ever epoch
-    train_f, train_t, chunks = Batch_and_Shuffle(x, y)
-    # loss_temp = np.zeros(chunks)
-    # acc_temp = np.zeros(chunks)
-
-    for j in range(chunks):
-      # loss_temp[j],acc_temp[j], opt_state, w = Train_Step(w, opt_state, train_f[j], train_t[j])
-      loss_data[step],acc_data[step], opt_state, w = Train_Step(w,opt_state,train_f[j],train_t[j])
-      step += 1
-
-    # loss_data[i] = np.average(loss_temp)
-    # acc_data[i] = np.average(acc_temp)
-
-    if (i+1) % 100 == 0:
-      print(f"{i+1}\t{loss_data[step-1]:.3f}\t{acc_data[step-1]*100:.2f}%")
-   
+  loss_data,acc_data, opt_state, w = Train_All(w,opt_state,x,y,jax.random.PRNGKey(SEED))
+  # Single copy of the results back to the host once the training is done
+  loss_data = np.asarray(loss_data)
+  acc_data = np.asarray(acc_data)
+
   file_weights = HOME_PATH + 'mps_w/final_mps_weights_training' +str(TRAIN_SIZE)+'_testing'+str(TEST_SIZE)+'.npy'
   np.save(file_weights, w)
 
-  return w, loss_data, acc_data
+  return w, np.reshape(loss_data,(-1)), np.reshape(acc_data,(-1))
 
 def Test_Model(w, x, y):
   print("Testing...")  
   print("\tLoss\tAccuracy")
   # Batch and shuffle the data for ever epoch
-  test_f, test_t, chunks = Batch_and_Shuffle(x, y)
-  loss_temp = np.zeros(chunks)
-  acc_temp = np.zeros(chunks)
-
-  for j in range(chunks):
-    loss_temp[j],acc_temp[j] = Test_Step(w, test_f[j], test_t[j])
-
-  loss_data = np.average(loss_temp)
-  acc_data = np.average(acc_temp)
+  test_f, test_t = Batch_and_Shuffle(x, y, jax.random.PRNGKey(SEED))
+  loss_temp,acc_temp = Run_Test(w, test_f, test_t)
+  # Single copy of the results back to the host once the testing is done
+  loss_data = np.average(np.asarray(loss_temp))
+  acc_data = np.average(np.asarray(acc_temp))
 
   print(f"\t{loss_data:.3f}\t{acc_data*100:.2f}%")
 
   return loss_data, acc_data
 
 def Plot_ROC(w,x,y):
-  z = int(len(x) / BATCH_SIZE)
-  new_x = np.split(x,z)
-  ps = np.zeros([z,BATCH_SIZE])
-  for i in range(z):
-    ps[i] = Circuit(new_x[i],w)
-  predictions = np.reshape(ps, (z*BATCH_SIZE))
+  predictions = np.asarray(Predict(w,x))
   fpr, tpr, threshold = roc_curve(y,predictions)
   auc = roc_auc_score(y,predictions)
   df_auc = np.ones(len(fpr))*auc
@@ -200,6 +266,10 @@ def Plot_Loss_and_Acc(ep,loss,acc):
 def Run_Model():
   # Loads the dataset (already preprocessed... see dataset.py)
   train_features,train_target,test_features,test_target = load_dataset(TRAIN_SIZE,TEST_SIZE,SEED)
+  # The jets are placed on the device once, the training and testing only index them there
+  # Training features are stored in bfloat16 to halve the memory traffic of the shuffled batches,
+  # the test features stay in float32 so that testing and the ROC are computed on the exact jets
+  train_features,train_target,test_features = jax.device_put((train_features.astype(jnp.bfloat16),train_target,test_features.astype(jnp.float32)))
   z = int(len(train_features) / BATCH_SIZE)
 
   path = HOME_PATH+'mps_w/'
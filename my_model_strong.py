@@ -21,6 +21,7 @@ N_QUBITS = 16
 LR=0.001 
 N_EPOCHS = 1000
 BATCH_SIZE = 1000
+MAX_LAYERS = 7
 HOME_PATH = '/home/leonidas/example-qml4btag/'
 
 #------------------------#
@@ -46,14 +47,19 @@ def Circuit(x,w):
   return qml.expval(qml.PauliZ(0)) # Expectation value of the \sigma_z operator on the 1st qubit
 
 # Simple MSE loss function
-def Loss(w,x,y):
-  pred = Circuit(x,w)
+def Loss(pred,y):
   return jnp.mean((pred - y) ** 2)
 
 # Simple binary accuracy function
-def Accuracy(w,x,y):
+# A jet is correctly classified when the prediction has the same sign as the target
+def Accuracy(pred,y):
+  return jnp.mean(pred*y > 0, dtype=jnp.float32)
+
+# The circuit is run only once per batch: the loss is returned with the accuracy
+# as auxiliary data, so jax.value_and_grad(..., has_aux=True) reuses the same forward pass
+def Loss_and_Acc(w,x,y):
   pred = Circuit(x,w)
-  return jnp.mean(jax.numpy.sign(pred) == y)
+  return Loss(pred,y), Accuracy(pred,y)
 
 # The ADAM optimizer is initialized
 optimizer = optax.adam(LR)
@@ -62,46 +68,88 @@ optimizer = optax.adam(LR)
 # This function is compiled Just-In-Time on the GPU
 @jax.jit
 def Train_Step(opt_state,w,x,y):
-  loss_value, grads = jax.value_and_grad(Loss,argnums=0)(w,x,y)
-  acc_value = Accuracy(w,x,y)
+  (loss_value,acc_value), grads = jax.value_and_grad(Loss_and_Acc,argnums=0,has_aux=True)(w,x,y)
   updates, opt_state = optimizer.update(grads, opt_state, w)
   w = optax.apply_updates(w, updates)
   return loss_value,acc_value, opt_state,w
 
 @jax.jit
 def Test_Step(w,x,y):
-  return Loss(w,x,y), Accuracy(w,x,y)
+  return Loss_and_Acc(w,x,y)
 
-def Batch_and_Shuffle(x,y):
-  z = int(len(x) / BATCH_SIZE)
-  data = jnp.column_stack([x,y])
-  jax.random.permutation(jax.random.PRNGKey(SEED),data)
-  return jnp.split(data[:,0:N_QUBITS],z), jnp.split(data[:,-1],z),z
+# Shuffle and batch the jets directly on the device
+# The jets are shuffled with a permutation drawn from the PRNG key and reshaped into
+# (n_batches, BATCH_SIZE, n_features) features and (n_batches, BATCH_SIZE) targets,
+# so the batches never leave the device
+@jax.jit
+def Batch_and_Shuffle(x,y,key):
+  z = x.shape[0] // BATCH_SIZE
+  idx = jax.random.permutation(key, x.shape[0])[:z*BATCH_SIZE]
+  return x[idx].reshape(z,BATCH_SIZE,x.shape[1]), y[idx].reshape(z,BATCH_SIZE)
+
+# A full epoch of training
+# lax.scan runs Train_Step over the leading (batch) axis of xs and ys inside a
+# single compiled loop, carrying the weights and the optimizer state and stacking
+# the loss and accuracy of every step
+@jax.jit
+def Run_Epoch(opt_state,w,xs,ys):
+  def Body(carry,batch):
+    opt_state,w = carry
+    loss_value,acc_value, opt_state,w = Train_Step(opt_state,w,batch[0],batch[1])
+    return (opt_state,w), (loss_value,acc_value)
+  (opt_state,w), (loss_values,acc_values) = jax.lax.scan(Body,(opt_state,w),(xs,ys))
+  return loss_values,acc_values, opt_state,w
+
+# The whole test set
+# lax.map runs Test_Step over the leading (batch) axis of xs and ys inside a single
+# compiled loop and stacks the loss and accuracy of every batch on the device
+@jax.jit
+def Run_Test(w,xs,ys):
+  return jax.lax.map(lambda batch: Test_Step(w,batch[0],batch[1]),(xs,ys))
+
+# Predictions for any number of jets with constant memory
+# The jets are padded to a multiple of BATCH_SIZE, and lax.map runs the vectorized
+# Circuit one batch at a time instead of on all the jets at once
+@jax.jit
+def Predict(w,x):
+  n = x.shape[0]
+  z = -(-n // BATCH_SIZE)
+  xs = jnp.pad(x,((0,z*BATCH_SIZE-n),(0,0))).reshape(z,BATCH_SIZE,x.shape[1])
+  return jax.lax.map(lambda batch: Circuit(batch,w),xs).reshape(-1)[:n]
+
+# The whole training on the device
+# lax.fori_loop runs the N_EPOCHS epochs inside a single compiled loop: every epoch
+# the jets are shuffled with a new key split from the carried one and passed to
+# Run_Epoch, and the loss and accuracy of every step are written in the
+# (N_EPOCHS, n_batches) arrays
+# The initial weights and optimizer state are donated, they are not used after the call
+@partial(jax.jit,donate_argnums=(0,1))
+def Train_All(opt_state,w,x,y,key):
+  z = x.shape[0] // BATCH_SIZE
+  def Epoch(i,carry):
+    opt_state,w,loss_data,acc_data,key = carry
+    key, subkey = jax.random.split(key)
+    train_f, train_t = Batch_and_Shuffle(x,y,subkey)
+    loss_values,acc_values, opt_state,w = Run_Epoch(opt_state,w,train_f,train_t)
+    # Progress line every 100 epochs, printed from inside the compiled loop
+    jax.lax.cond((i+1) % 100 == 0,
+                 lambda: jax.debug.print("{}\t{:.3f}\t{:.2f}%",i+1,jnp.mean(loss_values),jnp.mean(acc_values)*100),
+                 lambda: None)
+    return opt_state,w,loss_data.at[i].set(loss_values),acc_data.at[i].set(acc_values),key
+  loss_data = jnp.zeros((N_EPOCHS,z))
+  acc_data = jnp.zeros((N_EPOCHS,z))
+  opt_state,w,loss_data,acc_data,key = jax.lax.fori_loop(0,N_EPOCHS,Epoch,(opt_state,w,loss_data,acc_data,key))
+  return loss_data,acc_data, opt_state,w
 
 def Train_Model(w:optax.Params,x, y, layer):
   opt_state = optimizer.init(w)
-  z = int(len(x)/BATCH_SIZE)
-  loss_data = np.zeros(N_EPOCHS)
-  acc_data = np.zeros(N_EPOCHS)
   print("Training...")
   print("Epoch\tLoss\tAccuracy")
-  step=0
-  for i in range(N_EPOCHS):
-    
-    # Batch and shuffle the data for ever epoch
-    train_f, train_t, chunks = Batch_and_Shuffle(x, y)
-    loss_temp = np.zeros((chunks))
-    acc_temp = np.zeros((chunks))
-    for j in range(chunks):
-      loss_temp[j],acc_temp[j], opt_state,w = Train_Step(opt_state,w,train_f[j], train_t[j])
-      step+=1
-
-    loss_data[i] = np.mean(loss_temp)
-    acc_data[i] = np.mean(acc_temp)
-
-    if (i+1) % 100 == 0:
-      print(f"{i+1}\t{loss_data[i]:.3f}\t{acc_data[i]*100:.2f}%")
-  
+  loss_data,acc_data, opt_state,w = Train_All(opt_state,w,x,y,jax.random.PRNGKey(SEED))
+  # Single copy of the results back to the host once the training is done
+  loss_data = np.mean(np.asarray(loss_data),axis=1)
+  acc_data = np.mean(np.asarray(acc_data),axis=1)
+
   fweights = HOME_PATH+'strong_w/final_strong_weights_with_'+str(layer)+'layers'+'_training' +str(TRAIN_SIZE)+'_testing'+str(TEST_SIZE)+'.npy'
   np.save(fweights, w)
 
@@ -111,27 +159,18 @@ def Test_Model(w, x, y):
   print("Testing...")  
   print("\tLoss\tAccuracy")
   # Batch and shuffle the data for ever epoch
-  test_f, test_t, chunks = Batch_and_Shuffle(x, y)
-  loss_temp = np.zeros(chunks)
-  acc_temp = np.zeros(chunks)
-
-  for j in range(chunks):
-    loss_temp[j],acc_temp[j] = Test_Step(w, test_f[j], test_t[j])
-
-  loss_data = np.average(loss_temp)
-  acc_data = np.average(acc_temp)
+  test_f, test_t = Batch_and_Shuffle(x, y, jax.random.PRNGKey(SEED))
+  loss_temp,acc_temp = Run_Test(w, test_f, test_t)
+  # Single copy of the results back to the host once the testing is done
+  loss_data = np.average(np.asarray(loss_temp))
+  acc_data = np.average(np.asarray(acc_temp))
 
   print(f"\t{loss_data:.3f}\t{acc_data*100:.2f}%")
 
   return loss_data, acc_data
 
 def Plot_ROC(w,x,y,layer):
-  z = int(len(x) / BATCH_SIZE)
-  new_x = np.split(x,z)
-  ps = np.zeros([z,BATCH_SIZE])
-  for i in range(z):
-    ps[i] = Circuit(new_x[i],w)
-  predictions = np.reshape(ps, (z*BATCH_SIZE))
+  predictions = np.asarray(Predict(w,x))
   fpr, tpr, threshold = roc_curve(y,predictions)
   auc = roc_auc_score(y,predictions)
   df_auc = np.ones(len(fpr))*auc
@@ -185,13 +224,12 @@ def Plot_Loss_and_Acc(ep,loss,acc,layer):
   plt.clf()
 
 def Run_Model(train_features,train_target,test_features,test_target,pre_trained="file name"):
-  max_layers = 7
   z = int(len(train_features)/BATCH_SIZE)
-  train_loss_data = np.zeros([max_layers,N_EPOCHS])
-  train_acc_data = np.zeros([max_layers,N_EPOCHS])
-  test_loss = np.zeros([max_layers])
-  test_acc = np.zeros([max_layers])
-  for i in range(max_layers):
+  train_loss_data = np.zeros([MAX_LAYERS,N_EPOCHS])
+  train_acc_data = np.zeros([MAX_LAYERS,N_EPOCHS])
+  test_loss = np.zeros([MAX_LAYERS])
+  test_acc = np.zeros([MAX_LAYERS])
+  for i in range(MAX_LAYERS):
     # Weights are initialized randomly
     init_w = jax.random.uniform(jax.random.PRNGKey(SEED), ((i+1), N_QUBITS, 3))*jax.numpy.pi
 
@@ -212,6 +250,8 @@ def Run_Model(train_features,train_target,test_features,test_target,pre_trained=
 def Menu():
   # Loads the dataset (already preprocessed... see dataset.py)
   train_features,train_target,test_features,test_target = load_dataset(TRAIN_SIZE,TEST_SIZE,SEED,True)
+  # The jets are placed on the device once, every layer trains and tests on the same copy
+  train_features,train_target,test_features = jax.device_put((train_features,train_target,test_features))
 
   path = HOME_PATH+'strong_w/'
   weights_files = os.scandir(path) # Get the .npy weight files
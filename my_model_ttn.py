@@ -42,14 +42,19 @@ def Circuit(x,w):
   return qml.expval(qml.PauliZ(N_QUBITS-1)) # Expectation value of the \sigma_z operator on the last qubit
 
 # Simple MSE loss function
-def Loss(w,x,y):
-  pred = Circuit(x,w)
+def Loss(pred,y):
   return jnp.mean((pred - y) ** 2)
 
 # Simple binary accuracy function
-def Accuracy(w,x,y):
+# A jet is correctly classified when the prediction has the same sign as the target
+def Accuracy(pred,y):
+  return jnp.mean(pred*y > 0, dtype=jnp.float32)
+
+# The circuit is run only once per batch: the loss is returned with the accuracy
+# as auxiliary data, so jax.value_and_grad(..., has_aux=True) reuses the same forward pass
+def Loss_and_Acc(w,x,y):
   pred = Circuit(x,w)
-  return jnp.mean(jax.numpy.sign(pred) == y)
+  return Loss(pred,y), Accuracy(pred,y)
 
 # The ADAM optimizer is initialized
 optimizer = optax.adam(LR)
@@ -58,80 +63,108 @@ optimizer = optax.adam(LR)
 # This function is compiled Just-In-Time on the GPU
 @jax.jit
 def Train_Step(w, opt_state,x,y):
-  loss_value, grads = jax.value_and_grad(Loss,argnums=0)(w,x,y)
-  acc_value = Accuracy(w,x,y)
+  (loss_value,acc_value), grads = jax.value_and_grad(Loss_and_Acc,argnums=0,has_aux=True)(w,x,y)
   updates, opt_state = optimizer.update(grads, opt_state, w)
   w = optax.apply_updates(w, updates)
   return loss_value,acc_value, opt_state, w
 
 @jax.jit
 def Test_Step(w,x,y):
-  loss_value = Loss(w,x,y)
-  acc_value = Accuracy(w,x,y)
-  return loss_value, acc_value
+  return Loss_and_Acc(w,x,y)
+
+# Shuffle and batch the jets directly on the device
+# The jets are shuffled with a permutation drawn from the PRNG key and reshaped into
+# (n_batches, BATCH_SIZE, n_features) features and (n_batches, BATCH_SIZE) targets,
+# so the batches never leave the device
+@jax.jit
+def Batch_and_Shuffle(x,y,key):
+  z = x.shape[0] // BATCH_SIZE
+  idx = jax.random.permutation(key, x.shape[0])[:z*BATCH_SIZE]
+  return x[idx].reshape(z,BATCH_SIZE,x.shape[1]), y[idx].reshape(z,BATCH_SIZE)
+
+# A full epoch of training
+# lax.scan runs Train_Step over the leading (batch) axis of xs and ys inside a
+# single compiled loop, carrying the weights and the optimizer state and stacking
+# the loss and accuracy of every step
+@jax.jit
+def Run_Epoch(w,opt_state,xs,ys):
+  def Body(carry,batch):
+    w,opt_state = carry
+    loss_value,acc_value, opt_state,w = Train_Step(w,opt_state,batch[0],batch[1])
+    return (w,opt_state), (loss_value,acc_value)
+  (w,opt_state), (loss_values,acc_values) = jax.lax.scan(Body,(w,opt_state),(xs,ys))
+  return loss_values,acc_values, opt_state,w
+
+# The whole test set
+# lax.map runs Test_Step over the leading (batch) axis of xs and ys inside a single
+# compiled loop and stacks the loss and accuracy of every batch on the device
+@jax.jit
+def Run_Test(w,xs,ys):
+  return jax.lax.map(lambda batch: Test_Step(w,batch[0],batch[1]),(xs,ys))
 
-def Batch_and_Shuffle(x,y):
-  z = int(len(x) / BATCH_SIZE)
-  data = jnp.column_stack([x,y])
-  jax.random.permutation(jax.random.PRNGKey(SEED),data)
-  return jnp.split(data[:,0:N_QUBITS],z), jnp.split(data[:,-1],z),z
+# Predictions for any number of jets with constant memory
+# The jets are padded to a multiple of BATCH_SIZE, and lax.map runs the vectorized
+# Circuit one batch at a time instead of on all the jets at once
+@jax.jit
+def Predict(w,x):
+  n = x.shape[0]
+  z = -(-n // BATCH_SIZE)
+  xs = jnp.pad(x,((0,z*BATCH_SIZE-n),(0,0))).reshape(z,BATCH_SIZE,x.shape[1])
+  return jax.lax.map(lambda batch: Circuit(batch,w),xs).reshape(-1)[:n]
+
+# The whole training on the device
+# lax.fori_loop runs the N_EPOCHS epochs inside a single compiled loop: every epoch
+# the jets are shuffled with a new key split from the carried one and passed to
+# Run_Epoch, and the loss and accuracy of every step are written in the
+# (N_EPOCHS, n_batches) arrays
+# The initial weights and optimizer state are donated, they are not used after the call
+@partial(jax.jit,donate_argnums=(0,1))
+def Train_All(w,opt_state,x,y,key):
+  z = x.shape[0] // BATCH_SIZE
+  def Epoch(i,carry):
+    w,opt_state,loss_data,acc_data,key = carry
+    key, subkey = jax.random.split(key)
+    train_f, train_t = Batch_and_Shuffle(x,y,subkey)
+    loss_values,acc_values, opt_state,w = Run_Epoch(w,opt_state,train_f,train_t)
+    # Progress line every 100 epochs, printed from inside the compiled loop
+    jax.lax.cond((i+1) % 100 == 0,
+                 lambda: jax.debug.print("{}\t{:.3f}\t{:.2f}%",i+1,loss_values[-1],acc_values[-1]*100),
+                 lambda: None)
+    return w,opt_state,loss_data.at[i].set(loss_values),acc_data.at[i].set(acc_values),key
+  loss_data = jnp.zeros((N_EPOCHS,z))
+  acc_data = jnp.zeros((N_EPOCHS,z))
+  w,opt_state,loss_data,acc_data,key = jax.lax.fori_loop(0,N_EPOCHS,Epoch,(w,opt_state,loss_data,acc_data,key))
+  return loss_data,acc_data, opt_state,w
 
 def Train_Model(w:optax.Params,x, y):
   opt_state = optimizer.init(w)
-  z = int(len(x)/BATCH_SIZE)
-  loss_data = np.zeros(N_EPOCHS*z)
-  acc_data = np.zeros(N_EPOCHS*z)
   print("Training...")
   print("Epoch\tLoss\tAccuracy")
-  step=0
-  for i in range(N_EPOCHS):
-    
-    # Batch and shuffle the data for ever epoch
-    train_f, train_t, chunks = Batch_and_Shuffle(x, y)
-    # loss_temp = jnp.zeros(chunks)
-    # acc_temp = jnp.zeros(chunks)
-
-    for j in range(chunks):
-      # loss_temp[j],acc_temp[j], opt_state = Train_Step(step, opt_state, train_f[j], train_t[j])
-      loss_data[step],acc_data[step], opt_state, w = Train_Step(w, opt_state, train_f[j], train_t[j])
-      step+=1
-    
-    # loss_data[i] = jnp.average(loss_temp)
-    # acc_data[i] = jnp.average(acc_temp)
-
-    
-    if (i+1) % 100 == 0:
-      print(f"{i+1}\t{loss_data[i]:.3f}\t{acc_data[i]*100:.2f}%")
-   
+  loss_data,acc_data, opt_state, w = Train_All(w, opt_state, x, y, jax.random.PRNGKey(SEED))
+  # Single copy of the results back to the host once the training is done
+  loss_data = np.asarray(loss_data)
+  acc_data = np.asarray(acc_data)
+
   file_weights = HOME_PATH+'ttn_w/final_ttn_weights_training'+str(TRAIN_SIZE)+'_testing'+str(TEST_SIZE)+'.npy'
   np.save(file_weights, w)
 
-  return w, loss_data, acc_data
+  return w, np.reshape(loss_data,(-1)), np.reshape(acc_data,(-1))
 
 def Test_Model(w,x,y):
   print("Testing...")  
   print("\tLoss\tAccuracy")
   # Batch and shuffle the data for ever epoch
-  test_f, test_t, chunks = Batch_and_Shuffle(x, y)
-  loss_temp = np.zeros(chunks)
-  acc_temp = np.zeros(chunks)
-
-  for j in range(chunks):
-    loss_temp[j],acc_temp[j] = Test_Step(w, test_f[j], test_t[j])
-
-  loss_data = jnp.average(loss_temp)
-  acc_data = jnp.average(acc_temp)
+  test_f, test_t = Batch_and_Shuffle(x, y, jax.random.PRNGKey(SEED))
+  loss_temp,acc_temp = Run_Test(w, test_f, test_t)
+  # Single copy of the results back to the host once the testing is done
+  loss_data = np.average(np.asarray(loss_temp))
+  acc_data = np.average(np.asarray(acc_temp))
   print(f"\t{loss_data:.3f}\t{acc_data*100:.2f}%")
 
   return loss_data, acc_data
 
 def Plot_ROC(w,x,y):
-  z = int(len(x) / BATCH_SIZE)
-  new_x = np.split(x,z)
-  ps = np.zeros([z,BATCH_SIZE])
-  for i in range(z):
-    ps[i] = Circuit(new_x[i],w)
-  predictions = np.reshape(ps, (z*BATCH_SIZE))
+  predictions = np.asarray(Predict(w,x))
   fpr, tpr, threshold = roc_curve(y,predictions)
   auc = roc_auc_score(y,predictions)
   df_auc = np.ones(len(fpr))*auc
@@ -188,6 +221,8 @@ def Plot_Loss_and_Acc(ep,loss,acc):
 def Run_Model():
   # Loads the dataset (already preprocessed... see dataset.py)
   train_features,train_target,test_features,test_target = load_dataset(TRAIN_SIZE,TEST_SIZE,SEED)
+  # The jets are placed on the device once, the training and testing only index them there
+  train_features,train_target,test_features = jax.device_put((train_features,train_target,test_features))
   z = int(len(train_features) / BATCH_SIZE)
 
   path = HOME_PATH+'ttn_w/'